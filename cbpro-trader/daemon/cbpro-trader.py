@@ -58,6 +58,10 @@ class CBProTrader(object):
             self.cbpro_websocket.close()
         except:
             pass
+        try:
+            self.trade_engine.user_websocket.close()
+        except:
+            pass
         # Periods to update indicators for
         self.indicator_period_list = []
         # Periods to actively trade on (typically 1 per product)
@@ -86,12 +90,14 @@ class CBProTrader(object):
                     self.trade_period_list[cur_period['product']] = []
                 self.trade_period_list[cur_period['product']].append(new_period)
         max_slippage = Decimal(str(self.config['max_slippage']))
-        self.trade_engine = engine.TradeEngine(auth_client, product_list=self.product_list, fiat=fiat_currency, is_live=self.config['live'], max_slippage=max_slippage)
+        user_websocket = engine.UserWebsocket(self.config['key'], self.config['secret'], self.config['passphrase'], sandbox=self.config['sandbox'])
+        self.trade_engine = engine.TradeEngine(auth_client, product_list=self.product_list, fiat=fiat_currency, is_live=self.config['live'], max_slippage=max_slippage,
+                                               user_websocket=user_websocket)
         self.cbpro_websocket = engine.TradeAndHeartbeatWebsocket(fiat=fiat_currency, sandbox=self.config['sandbox'])
         self.cbpro_websocket.start()
         self.indicator_period_list[0].verbose_heartbeat = True
         self.indicator_subsys = indicators.IndicatorSubsystem(self.indicator_period_list)
-        self.last_indicator_update = time.time()
+        self.last_indicator_update = time.monotonic()
 
         self.init_interface()
         self.initializing = False
@@ -108,12 +114,12 @@ class CBProTrader(object):
                     if msg.get('type') == "match":
                         for cur_period in self.indicator_period_list:
                             cur_period.process_trade(msg)
-                        if time.time() - self.last_indicator_update >= 1.0:
+                        if time.monotonic() - self.last_indicator_update >= 1.0:
                             for cur_period in self.indicator_period_list:
                                 self.indicator_subsys.recalculate_indicators(cur_period)
                             for product_id, period_list in self.trade_period_list.items():
                                 self.trade_engine.determine_trades(product_id, period_list, self.indicator_subsys.current_indicators)
-                            self.last_indicator_update = time.time()
+                            self.last_indicator_update = time.monotonic()
                     elif msg.get('type') == "heartbeat":
                         for cur_period in self.indicator_period_list:
                             cur_period.process_heartbeat(msg)
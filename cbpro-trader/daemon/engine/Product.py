@@ -1,17 +1,23 @@
 import time
+import threading
+from decimal import Decimal
 from .OrderBookCustom import OrderBookCustom
 
 class Product(object):
     def __init__(self, auth_client, product_id='BTC-USD'):
         self.product_id = product_id
         self.order_book = OrderBookCustom(product_id=product_id, auth_client=auth_client)
+        self.lock = threading.Lock()
         self.order_in_progress = False
         self.buy_flag = False
         self.sell_flag = False
         self.open_orders = []
-        self.order_thread = None
+        self.live_order_ids = set()
+        # When open_orders last changed outside a REST reconcile, see TradeEngine.update_orders
+        self.last_order_event = 0
+        self.order_future = None
         self.meta = True
-        self.last_signal_switch = time.time()
+        self.last_signal_switch = time.monotonic()
 
         cbpro_products = auth_client.get_products()
         while not isinstance(cbpro_products, list):
@@ -23,4 +29,7 @@ class Product(object):
             if product_id == cbpro_product.get('id'):
                 self.meta = False # If product_id is in response, it must be a real product
                 self.quote_increment = cbpro_product.get('quote_increment')
-                self.min_size = cbpro_product.get('base_min_size')
\ No newline at end of file
+                self.min_size = cbpro_product.get('base_min_size')
+                # Decimal copies so the trading loops don't re-parse the strings
+                self.quote_increment_d = Decimal(self.quote_increment)
+                self.min_size_d = Decimal(self.min_size)
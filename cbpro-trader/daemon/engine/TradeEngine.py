@@ -3,11 +3,36 @@ import logging
 import threading
 import datetime
 import itertools
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, ROUND_DOWN
 from .Product import Product
 
+# Seconds a fetched set of account balances is considered fresh
+BALANCE_TTL = 1.0
+
+# Seconds a signal must hold after a reversal before orders are placed on it
+MIN_SIGNAL_DWELL_SEC = 2.0
+
+# Bounds for the adaptive sleep in the buy/sell order loops
+ORDER_LOOP_MIN_SLEEP = 0.01
+ORDER_LOOP_MAX_SLEEP = 0.2
+
+# Seconds between REST open order reconciliations while the user feed is pushing updates
+ORDER_RECONCILE_INTERVAL = 30.0
+
+# Upper bound on open orders read per poll, so large accounts don't page through everything
+MAX_OPEN_ORDERS = 1000
+
+# Decimal constants used on the hot trading paths, parsed once
+_D_ZERO = Decimal('0.0')
+_D_HALF = Decimal('0.5')
+_D_ONE = Decimal('1.0')
+_D_HUNDRED = Decimal('100.0')
+_D_CENT = Decimal('.01')
+_D_SATOSHI = Decimal('.00000001')
+
 class TradeEngine():
-    def __init__(self, auth_client, product_list=['BTC-USD', 'ETH-USD', 'LTC-USD'], fiat='USD', is_live=False, max_slippage=Decimal('0.10')):
+    def __init__(self, auth_client, product_list=['BTC-USD', 'ETH-USD', 'LTC-USD'], fiat='USD', is_live=False, max_slippage=Decimal('0.10'), user_websocket=None):
         self.logger = logging.getLogger('trader-logger')
         self.error_logger = logging.getLogger('error-logger')
         self.auth_client = auth_client
@@ -17,53 +42,94 @@ class TradeEngine():
         self.market_orders = True # TODO: make this a config option
         self.available_products = []
         self.products = []
-        self.balances = {}
         self.stop_update_order_thread = False
-        self.last_order_update = time.time()
+        self.orders_cv = threading.Condition()
+        self.last_order_update = time.monotonic()
+        self.last_order_reconcile = 0
         self.all_open_orders = []
         self.recent_fills = []
         for product in self.product_list:
             self.products.append(Product(auth_client, product_id=product))
+        self.product_by_id = {product.product_id: product for product in self.products}
+        self.product_id_set = set(self.product_list)
+        # (base, quoted) currency for each product, e.g. 'BTC-USD' -> ('BTC', 'USD')
+        self.currency_map = {product_id: (product_id[:3], product_id[4:]) for product_id in self.product_list}
+        # Crypto-quoted pairs only trade alongside their fiat counterparts,
+        # resolve those (base-fiat, BTC-fiat) products once up front
+        self.linked_fiat_products = {}
+        for product_id in self.product_list:
+            if product_id == 'LTC-BTC' or product_id == 'ETH-BTC':
+                self.linked_fiat_products[product_id] = (self.get_product_by_product_id(product_id[:3] + '-' + self.fiat_currency),
+                                                         self.get_product_by_product_id('BTC-' + self.fiat_currency))
+        # Start every currency we trade at zero so lookups never fail before
+        # the first successful get_accounts. Failed refreshes keep the last
+        # known balances rather than resetting them.
+        self.balances = {currency: _D_ZERO for currencies in self.currency_map.values() for currency in currencies}
+        self.balances.update({'BTC': _D_ZERO, self.fiat_currency: _D_ZERO, 'fiat_equivalent': _D_ZERO})
         self.last_balance_update = 0
         self.update_amounts()
         self.init_available_products()
-        self.last_balance_update = time.time()
+        self.last_balance_update = time.monotonic()
         self.max_slippage = max_slippage
+        # Reused worker threads for the buy/sell order loops
+        self.order_executor = ThreadPoolExecutor(max_workers=max(4, len(self.products)), thread_name_prefix='order')
+        self.user_websocket = user_websocket
+        if self.user_websocket:
+            # Only real products can be subscribed to, not meta products
+            self.user_websocket.products = [product.product_id for product in self.products if not product.meta]
+            self.user_websocket.callback = self.process_order_message
+            self.user_websocket.start()
         self.update_order_thread = threading.Thread(target=self.update_orders, name='update_orders')
         self.update_order_thread.start()
 
     def close(self, exit=False):
         if exit:
             self.stop_update_order_thread = True
+            self.notify_order_update()
         for product in self.products:
-            # Setting both flags will close any open order threads
-            product.buy_flag = False
-            product.sell_flag = False
-            # Cancel any orders that may still be remaining
-            product.order_in_progress = False
+            with product.lock:
+                # Setting both flags will close any open order threads
+                product.buy_flag = False
+                product.sell_flag = False
+                # Cancel any orders that may still be remaining
+                product.order_in_progress = False
         try:
             self.auth_client.cancel_all()
+            for product in self.products:
+                with product.lock:
+                    product.open_orders = []
+                    product.live_order_ids = set()
+                    product.last_order_event = time.monotonic()
         except Exception:
             self.error_logger.exception(datetime.datetime.now())
+        if exit:
+            self.order_executor.shutdown(wait=True)
+            if self.user_websocket:
+                self.user_websocket.close()
 
     def get_product_by_product_id(self, product_id='BTC-USD'):
-        for product in self.products:
-            if product.product_id == product_id:
-                return product
-        return None
+        return self.product_by_id.get(product_id)
 
     def init_available_products(self):
         for product in self.auth_client.get_products():
             self.available_products.append(product.get('id'))
 
+    def notify_order_update(self):
+        # Wake the update_orders thread so it can exit without waiting out its timeout
+        with self.orders_cv:
+            self.orders_cv.notify()
+
     def update_orders(self):
         while not self.stop_update_order_thread:
-            need_updating = False
-            for product in self.products:
-                if product.order_in_progress:
-                    need_updating = True
+            with self.orders_cv:
+                self.orders_cv.wait_for(lambda: self.stop_update_order_thread,
+                                        timeout=max(0, 1.0 - (time.monotonic() - self.last_order_update)))
+            if self.stop_update_order_thread:
+                break
 
-            if time.time() - self.last_order_update >= 1.0:
+            need_updating = any(product.order_in_progress for product in self.products)
+
+            if time.monotonic() - self.last_order_update >= 1.0:
                 self.temp_recent_fills = []
                 try:
                     for product in self.products:
@@ -71,178 +137,285 @@ class TradeEngine():
                         self.recent_fills = sorted(self.temp_recent_fills, key=lambda x: x['created_at'], reverse=True)[:5]
                 except Exception:
                     self.error_logger.exception(datetime.datetime.now())
-                if need_updating:
+                # With a live user feed pushing order changes, polling is only
+                # needed occasionally to correct any drift
+                if need_updating and (not self.user_feed_alive() or
+                                      time.monotonic() - self.last_order_reconcile >= ORDER_RECONCILE_INTERVAL):
                     try:
-                        self.all_open_orders = list(self.auth_client.get_orders())
+                        fetch_started = time.monotonic()
+                        self.last_order_reconcile = fetch_started
+                        open_orders = [order for order in itertools.islice(self.auth_client.get_orders(), MAX_OPEN_ORDERS)
+                                       if order.get('product_id') in self.product_id_set]
+                        orders_by_product = {}
+                        for order in open_orders:
+                            orders_by_product.setdefault(order.get('product_id'), []).append(order)
                         for product in self.products:
-                            product.open_orders = []
-                        for order in self.all_open_orders:
-                            self.get_product_by_product_id(order.get('product_id')).open_orders.append(order)
+                            with product.lock:
+                                # A feed event or our own change during the fetch is newer than this snapshot
+                                if product.last_order_event > fetch_started:
+                                    continue
+                                product.open_orders = orders_by_product.get(product.product_id, [])
+                                product.live_order_ids = {order.get('id') for order in product.open_orders}
+                        self.all_open_orders = [order for product in self.products for order in product.open_orders]
                     except Exception:
                         self.error_logger.exception(datetime.datetime.now())
                 elif not need_updating:
                     self.all_open_orders = []
-                self.last_order_update = time.time()
-            time.sleep(0.01)
+                self.last_order_update = time.monotonic()
+
+    def user_feed_alive(self):
+        return self.user_websocket is not None and self.user_websocket.is_alive()
+
+    def process_order_message(self, msg):
+        msg_type = msg.get('type')
+        if msg_type not in ('open', 'match', 'done', 'change'):
+            return
+        product = self.get_product_by_product_id(msg.get('product_id'))
+        if product is None:
+            return
+        if msg_type == 'match':
+            order_id = msg.get('maker_order_id') if msg.get('maker_order_id') in product.live_order_ids else msg.get('taker_order_id')
+        else:
+            order_id = msg.get('order_id')
+
+        with product.lock:
+            open_orders = [order for order in product.open_orders if order.get('id') != order_id]
+            order = next((order for order in product.open_orders if order.get('id') == order_id), None)
+            if msg_type == 'open':
+                if order is None:
+                    order = {'id': order_id, 'product_id': product.product_id, 'side': msg.get('side'),
+                             'price': msg.get('price'), 'size': msg.get('remaining_size'), 'filled_size': '0'}
+                open_orders.append(dict(order, status='open'))
+            elif msg_type == 'match' and order is not None:
+                filled_size = Decimal(order.get('filled_size') or '0') + Decimal(msg.get('size'))
+                open_orders.append(dict(order, filled_size=str(filled_size)))
+            elif msg_type == 'change' and order is not None:
+                open_orders.append(dict(order, size=msg.get('new_size')))
+            # 'done' orders are simply left out of the new list
+            product.open_orders = open_orders
+            product.live_order_ids = {order.get('id') for order in open_orders}
+            product.last_order_event = time.monotonic()
+        self.all_open_orders = [order for cur_product in self.products for order in cur_product.open_orders]
 
     def round_fiat(self, money):
-        return Decimal(money).quantize(Decimal('.01'), rounding=ROUND_DOWN)
+        return Decimal(money).quantize(_D_CENT, rounding=ROUND_DOWN)
 
     def round_coin(self, money):
-        return Decimal(money).quantize(Decimal('.00000001'), rounding=ROUND_DOWN)
+        return Decimal(money).quantize(_D_SATOSHI, rounding=ROUND_DOWN)
+
+    def order_price(self, order):
+        # Parsed once per order response rather than on every loop iteration
+        return Decimal(order['price']) if order.get('price') else None
+
+    def balances_stale(self):
+        return time.monotonic() - self.last_balance_update > BALANCE_TTL
 
     def update_amounts(self):
-        if time.time() - self.last_balance_update > 1.0:
+        if self.balances_stale():
             try:
-                self.last_balance_update = time.time()
+                self.last_balance_update = time.monotonic()
                 ret = self.auth_client.get_accounts()
+                # Build a fresh dict and publish it with a single assignment so
+                # readers on other threads never see a partially updated view
+                balances = self.balances.copy()
                 if isinstance(ret, list):
                     for account in ret:
-                        self.balances[account['currency']] = self.round_coin(account.get('available'))
+                        balances[account['currency']] = self.round_coin(account.get('available'))
             except Exception:
                 self.error_logger.exception(datetime.datetime.now())
                 return
-            self.balances['fiat_equivalent'] = Decimal('0.0')
-            for product in self.products:
-                if not product.meta and product.order_book.get_current_ticker() and product.order_book.get_current_ticker().get('price'):
-                    self.balances['fiat_equivalent'] += self.get_base_currency_from_product_id(product.product_id, update=False) * Decimal(product.order_book.get_current_ticker().get('price'))
-            self.balances['fiat_equivalent'] += self.balances[self.fiat_currency]
+            # Read each ticker once, it's shared with the websocket thread
+            tickers = ((product, product.order_book.get_current_ticker()) for product in self.products if not product.meta)
+            balances['fiat_equivalent'] = balances[self.fiat_currency] + sum(
+                (balances[self.currency_map[product.product_id][0]] * Decimal(ticker.get('price'))
+                 for product, ticker in tickers if ticker and ticker.get('price')), _D_ZERO)
+            self.balances = balances
 
     def print_amounts(self):
         self.logger.debug("[BALANCES] %s: %.2f BTC: %.8f" % (self.fiat_currency, self.balances[self.fiat_currency], self.balances['BTC']))
 
-    def place_buy(self, product=None, partial='1.0'):
-        amount = self.get_quoted_currency_from_product_id(product.product_id) * Decimal(partial)
-        bid = product.order_book.get_ask() - Decimal(product.quote_increment)
-        amount = self.round_coin(Decimal(amount) / Decimal(bid))
+    def find_open_order(self, product, side, price, size=None):
+        for order in product.open_orders:
+            if order.get('side') == side and order.get('price') and Decimal(order.get('price')) == price:
+                if size is None or (order.get('size') and Decimal(order.get('size')) == size):
+                    return order
+        return None
+
+    def cancel_product_orders(self, product):
+        # Keep our view in step with the exchange so nothing matches a cancelled order
+        self.auth_client.cancel_all(product_id=product.product_id)
+        with product.lock:
+            product.open_orders = []
+            product.live_order_ids = set()
+            product.last_order_event = time.monotonic()
+
+    def drop_open_order(self, product, order_id):
+        with product.lock:
+            product.open_orders = [order for order in product.open_orders if order.get('id') != order_id]
+            product.live_order_ids = product.live_order_ids - {order_id}
+            product.last_order_event = time.monotonic()
+
+    def place_buy(self, product=None, partial=_D_ONE):
+        amount = self.get_quoted_currency_from_product_id(product.product_id) * partial
+        bid = product.order_book.get_ask() - product.quote_increment_d
+        amount = self.round_coin(amount / bid)
 
-        if amount < Decimal(product.min_size):
+        if amount < product.min_size_d:
             amount = self.get_quoted_currency_from_product_id(product.product_id)
-            bid = product.order_book.get_ask() - Decimal(product.quote_increment)
-            amount = self.round_coin(Decimal(amount) / Decimal(bid))
+            bid = product.order_book.get_ask() - product.quote_increment_d
+            amount = self.round_coin(amount / bid)
 
-        if amount >= Decimal(product.min_size):
+        if amount >= product.min_size_d:
+            existing = self.find_open_order(product, 'buy', bid, amount)
+            if existing:
+                return existing
             self.logger.debug("Placing buy... Price: %.8f Size: %.8f" % (bid, amount))
             ret = self.auth_client.place_limit_order(product.product_id, "buy", size=str(amount),
                                                      price=str(bid), post_only=True)
             if ret.get('status') == 'pending' or ret.get('status') == 'open':
-                product.open_orders.append(ret)
+                # Publish new containers rather than mutating the ones readers may hold
+                with product.lock:
+                    product.open_orders = product.open_orders + [ret]
+                    product.live_order_ids = product.live_order_ids | {ret.get('id')}
+                    product.last_order_event = time.monotonic()
             return ret
         else:
             ret = {'status': 'done'}
             return ret
 
-    def buy(self, product=None, amount=None):
-        product.order_in_progress = True
-        last_order_update = 0
-        starting_price = product.order_book.get_ask() - Decimal(product.quote_increment)
-        try:
-            ret = self.place_buy(product=product, partial='0.5')
-            bid = ret.get('price')
-            amount = self.get_quoted_currency_from_product_id(product.product_id)
-            while product.buy_flag and (amount >= Decimal(product.min_size) or len(product.open_orders) > 0):
-                if (((product.order_book.get_ask() - Decimal(product.quote_increment)) / starting_price) - Decimal('1.0')) * Decimal('100.0') > self.max_slippage:
-                    self.auth_client.cancel_all(product_id=product.product_id)
-                    self.auth_client.place_market_order(product.product_id, "buy", funds=str(self.get_quoted_currency_from_product_id(product.product_id)))
-                    product.order_in_progress = False
-                    return
-                if ret.get('status') == 'rejected' or ret.get('status') == 'done' or ret.get('message') == 'NotFound':
-                    ret = self.place_buy(product=product, partial='0.5')
-                    bid = ret.get('price')
-                elif not bid or Decimal(bid) < product.order_book.get_ask() - Decimal(product.quote_increment):
-                    if len(product.open_orders) > 0:
-                        ret = self.place_buy(product=product, partial='1.0')
-                    else:
-                        ret = self.place_buy(product=product, partial='0.5')
-                    for order in product.open_orders:
-                        if order.get('id') != ret.get('id'):
-                            self.auth_client.cancel_order(order.get('id'))
-                    bid = ret.get('price')
-                if ret.get('id') and time.time() - last_order_update >= 1.0:
-                    try:
-                        ret = self.auth_client.get_order(ret.get('id'))
-                        last_order_update = time.time()
-                    except ValueError:
-                        self.error_logger.exception(datetime.datetime.now())
-                        pass
-                amount = self.get_quoted_currency_from_product_id(product.product_id)
-                time.sleep(0.01)
-            self.auth_client.cancel_all(product_id=product.product_id)
-            amount = self.get_quoted_currency_from_product_id(product.product_id)
-        except Exception:
-            product.order_in_progress = False
-            self.error_logger.exception(datetime.datetime.now())
-        self.auth_client.cancel_all(product_id=product.product_id)
-        product.order_in_progress = False
-
-    def place_sell(self, product=None, partial='1.0'):
-        amount = self.round_coin(self.get_base_currency_from_product_id(product.product_id) * Decimal(partial))
-        if amount < Decimal(product.min_size):
+    def place_sell(self, product=None, partial=_D_ONE):
+        amount = self.round_coin(self.get_base_currency_from_product_id(product.product_id) * partial)
+        if amount < product.min_size_d:
             amount = self.get_base_currency_from_product_id(product.product_id)
-        ask = product.order_book.get_bid() + Decimal(product.quote_increment)
+        ask = product.order_book.get_bid() + product.quote_increment_d
 
-        if amount >= Decimal(product.min_size):
+        if amount >= product.min_size_d:
+            existing = self.find_open_order(product, 'sell', ask, amount)
+            if existing:
+                return existing
             self.logger.debug("Placing sell... Price: %.2f Size: %.8f" % (ask, amount))
             ret = self.auth_client.place_limit_order(product.product_id, "sell", size=str(amount),
                                                      price=str(ask), post_only=True)
             if ret.get('status') == 'pending' or ret.get('status') == 'open':
-                product.open_orders.append(ret)
+                # Publish new containers rather than mutating the ones readers may hold
+                with product.lock:
+                    product.open_orders = product.open_orders + [ret]
+                    product.live_order_ids = product.live_order_ids | {ret.get('id')}
+                    product.last_order_event = time.monotonic()
             return ret
         else:
             ret = {'status': 'done'}
             return ret
 
+    def buy(self, product=None, amount=None):
+        self.trade(product, 'buy')
+
     def sell(self, product=None, amount=None):
+        self.trade(product, 'sell')
+
+    def trade(self, product, side):
+        # Shared limit order loop for both sides. Buys rest one increment
+        # under the ask and chase it up, sells rest one increment over the
+        # bid and chase it down; sign flips the direction of the comparisons.
+        if side == 'buy':
+            sign = 1
+            book_price = product.order_book.get_ask
+            place = self.place_buy
+            get_balance = self.get_quoted_currency_from_product_id
+        else:
+            sign = -1
+            book_price = product.order_book.get_bid
+            place = self.place_sell
+            get_balance = self.get_base_currency_from_product_id
+        side_flag = side + '_flag'
+
         product.order_in_progress = True
         last_order_update = 0
-        starting_price = product.order_book.get_bid() + Decimal(product.quote_increment)
         try:
-            ret = self.place_sell(product=product, partial='0.5')
-            ask = ret.get('price')
-            amount = self.get_base_currency_from_product_id(product.product_id)
-            while product.sell_flag and (amount >= Decimal(product.min_size) or len(product.open_orders) > 0):
-                if (Decimal('1') - ((product.order_book.get_bid() + Decimal(product.quote_increment)) / starting_price)) * Decimal('100.0') > self.max_slippage:
-                    self.auth_client.cancel_all(product_id=product.product_id)
-                    self.auth_client.place_market_order(product.product_id, "sell", size=str(self.get_base_currency_from_product_id(product.product_id)))
+            starting_price = book_price() - sign * product.quote_increment_d
+            ret = place(product=product, partial=_D_HALF)
+            price = self.order_price(ret)
+            prev_target = starting_price
+            sleep_dt = ORDER_LOOP_MIN_SLEEP
+            amount = get_balance(product.product_id)
+            while getattr(product, side_flag) and (amount >= product.min_size_d or len(product.open_orders) > 0):
+                cur_target = book_price() - sign * product.quote_increment_d
+                if sign * ((cur_target / starting_price) - _D_ONE) * _D_HUNDRED > self.max_slippage:
+                    self.cancel_product_orders(product)
+                    if side == 'buy':
+                        self.auth_client.place_market_order(product.product_id, side, funds=str(get_balance(product.product_id)))
+                    else:
+                        self.auth_client.place_market_order(product.product_id, side, size=str(get_balance(product.product_id)))
                     product.order_in_progress = False
                     return
                 if ret.get('status') == 'rejected' or ret.get('status') == 'done' or ret.get('message') == 'NotFound':
-                    ret = self.place_sell(product=product, partial='0.5')
-                    ask = ret.get('price')
-                elif not ask or Decimal(ask) > product.order_book.get_bid() + Decimal(product.quote_increment):
-                    if len(product.open_orders) > 0:
-                        ret = self.place_sell(product=product, partial='1.0')
+                    ret = place(product=product, partial=_D_HALF)
+                    price = self.order_price(ret)
+                elif price is None or sign * (cur_target - price) > 0:
+                    existing = self.find_open_order(product, side, cur_target)
+                    if existing:
+                        # Already resting at the target price, no need to reissue.
+                        # Cancel the order we were tracking so it isn't left behind.
+                        if ret.get('id') and ret.get('id') != existing.get('id'):
+                            self.auth_client.cancel_order(ret.get('id'))
+                            self.drop_open_order(product, ret.get('id'))
+                        ret = existing
                     else:
-                        ret = self.place_sell(product=product, partial='0.5')
-                    for order in product.open_orders:
-                        if order.get('id') != ret.get('id'):
-                            self.auth_client.cancel_order(order.get('id'))
-                    ask = ret.get('price')
-                if ret.get('id') and time.time() - last_order_update >= 1.0:
+                        partial = _D_ONE if len(product.open_orders) > 0 else _D_HALF
+                        # Clear out the stale orders in one round-trip before reissuing
+                        self.cancel_product_orders(product)
+                        ret = place(product=product, partial=partial)
+                    price = self.order_price(ret)
+                if ret.get('id') and time.monotonic() - last_order_update >= 1.0:
                     try:
                         ret = self.auth_client.get_order(ret.get('id'))
                     except ValueError:
                         self.error_logger.exception(datetime.datetime.now())
                         pass
-                    last_order_update = time.time()
-                amount = self.get_base_currency_from_product_id(product.product_id)
-                time.sleep(0.01)
-            self.auth_client.cancel_all(product_id=product.product_id)
-            amount = self.get_base_currency_from_product_id(product.product_id)
+                    last_order_update = time.monotonic()
+                amount = get_balance(product.product_id)
+                # Back off while the book is quiet, react quickly once it moves
+                if cur_target == prev_target:
+                    sleep_dt = min(sleep_dt * 2, ORDER_LOOP_MAX_SLEEP)
+                else:
+                    sleep_dt = ORDER_LOOP_MIN_SLEEP
+                prev_target = cur_target
+                time.sleep(sleep_dt)
+            self.cancel_product_orders(product)
         except Exception:
-            product.order_in_progress = False
             self.error_logger.exception(datetime.datetime.now())
-        self.auth_client.cancel_all(product_id=product.product_id)
-        product.order_in_progress = False
+        try:
+            self.cancel_product_orders(product)
+        finally:
+            # Always release the product, or it would never get another order loop
+            product.order_in_progress = False
 
     def get_base_currency_from_product_id(self, product_id, update=True):
-        if update:
+        if update and self.balances_stale():
             self.update_amounts()
-        return self.balances[product_id[:3]]
+        return self.balances[self.currency_map[product_id][0]]
 
     def get_quoted_currency_from_product_id(self, product_id):
-        self.update_amounts()
-        return self.balances[product_id[4:]]
+        if self.balances_stale():
+            self.update_amounts()
+        return self.balances[self.currency_map[product_id][1]]
+
+    def claim_order(self, product):
+        # Mark the product busy before the order loop is queued, so a later
+        # tick can't submit a second loop before the first one starts
+        with product.lock:
+            if product.order_in_progress:
+                return False
+            product.order_in_progress = True
+            return True
+
+    def log_order_future(self, future):
+        # Nothing else waits on the order loop futures, so surface their errors here
+        if not future.cancelled() and future.exception() is not None:
+            self.error_logger.error(datetime.datetime.now(), exc_info=future.exception())
+
+    def signal_settled(self, product):
+        return time.monotonic() - product.last_signal_switch >= MIN_SIGNAL_DWELL_SEC
 
     def determine_trades(self, product_id, period_list, indicators):
         self.update_amounts()
@@ -254,45 +427,49 @@ class TradeEngine():
             new_sell_flag = False
             for cur_period in period_list:
                 # Moving Average Strategy
-                new_buy_flag = new_buy_flag and Decimal(indicators[cur_period.name]['sma_trend']) > Decimal('0.0')
-                new_sell_flag = new_sell_flag or Decimal(indicators[cur_period.name]['sma_trend']) < Decimal('0.0')
+                sma_trend = indicators[cur_period.name]['sma_trend']
+                new_buy_flag = new_buy_flag and sma_trend > 0.0
+                new_sell_flag = new_sell_flag or sma_trend < 0.0
 
-            if product_id == 'LTC-BTC' or product_id == 'ETH-BTC':
-                ltc_or_eth_fiat_product = self.get_product_by_product_id(product_id[:3] + '-' + self.fiat_currency)
-                btc_fiat_product = self.get_product_by_product_id('BTC-' + self.fiat_currency)
+            linked = self.linked_fiat_products.get(product_id)
+            if linked:
+                ltc_or_eth_fiat_product, btc_fiat_product = linked
                 new_buy_flag = new_buy_flag and ltc_or_eth_fiat_product.buy_flag
                 new_sell_flag = new_sell_flag and btc_fiat_product.buy_flag
 
             if new_buy_flag:
-                if product.sell_flag:
-                    product.last_signal_switch = time.time()
-                product.sell_flag = False
-                product.buy_flag = True
+                with product.lock:
+                    if product.sell_flag:
+                        product.last_signal_switch = time.monotonic()
+                    product.sell_flag = False
+                    product.buy_flag = True
                 amount = self.round_fiat(self.get_quoted_currency_from_product_id(product_id))
-                if amount >= Decimal(product.min_size):
+                if amount >= product.min_size_d and self.signal_settled(product):
                     if self.market_orders:
                         ret = self.auth_client.place_market_order(product.product_id, "buy", funds=str(amount))
                         self.logger.debug(ret)
                         self.logger.debug(amount)
                     else:
-                        if not product.order_in_progress:
-                            bid = product.order_book.get_ask() - Decimal(product.quote_increment)
-                            amount = self.round_coin(Decimal(amount) / Decimal(bid))
-                            product.order_thread = threading.Thread(target=self.buy, name='buy_thread', kwargs={'product': product})
-                            product.order_thread.start()
+                        if self.claim_order(product):
+                            bid = product.order_book.get_ask() - product.quote_increment_d
+                            amount = self.round_coin(amount / bid)
+                            product.order_future = self.order_executor.submit(self.buy, product=product)
+                            product.order_future.add_done_callback(self.log_order_future)
             elif new_sell_flag:
-                if product.buy_flag:
-                    product.last_signal_switch = time.time()
-                product.buy_flag = False
-                product.sell_flag = True
+                with product.lock:
+                    if product.buy_flag:
+                        product.last_signal_switch = time.monotonic()
+                    product.buy_flag = False
+                    product.sell_flag = True
                 amount_of_coin = self.round_coin(self.get_base_currency_from_product_id(product_id))
-                if amount_of_coin >= Decimal(product.min_size):
+                if amount_of_coin >= product.min_size_d and self.signal_settled(product):
                     if self.market_orders:
                         self.auth_client.place_market_order(product.product_id, "sell", size=str(amount_of_coin))
                     else:
-                        if not product.order_in_progress:
-                            product.order_thread = threading.Thread(target=self.sell, name='sell_thread', kwargs={'product': product})
-                            product.order_thread.start()
+                        if self.claim_order(product):
+                            product.order_future = self.order_executor.submit(self.sell, product=product)
+                            product.order_future.add_done_callback(self.log_order_future)
             else:
-                product.buy_flag = False
-                product.sell_flag = False
+                with product.lock:
+                    product.buy_flag = False
+                    product.sell_flag = False
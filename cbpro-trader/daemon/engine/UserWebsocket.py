@@ -0,0 +1,72 @@
+import datetime
+import logging
+import cbpro
+from websocket import WebSocketConnectionClosedException
+
+# Seconds to wait for the listener thread when closing
+CLOSE_TIMEOUT = 5.0
+
+class UserWebsocket(cbpro.WebsocketClient):
+    def __init__(self, key, secret, passphrase, products=None, sandbox=False):
+        self.logger = logging.getLogger('trader-logger')
+        self.error_logger = logging.getLogger('error-logger')
+        # Called with every order message, set by the TradeEngine that owns this feed
+        self.callback = None
+        self.channels = ['user']
+        if sandbox:
+            url="wss://ws-feed-public.sandbox.pro.coinbase.com"
+        else:
+            url="wss://ws-feed.pro.coinbase.com"
+        super(UserWebsocket, self).__init__(products=products, channels=self.channels, url=url, auth=True,
+                                            api_key=key, api_secret=secret, api_passphrase=passphrase)
+
+    def is_alive(self):
+        # The listener thread can also die without setting stop or error,
+        # e.g. when the initial connection fails
+        return (not self.stop and self.error is None and
+                self.thread is not None and self.thread.is_alive())
+
+    def on_open(self):
+        self.stop = False
+        self.logger.debug("-- CBPRO User Websocket Opened ---")
+
+    def on_close(self):
+        self.logger.debug("-- CBPRO User Websocket Closed ---")
+
+    def on_error(self, e):
+        if self.stop:
+            # recv() raising because close() shut the socket, not a real error
+            return
+        self.error_logger.exception(datetime.datetime.now())
+        self.error = e
+        self.stop = True
+        raise e
+
+    def close(self):
+        if not self.stop:
+            self.on_close()
+            self.stop = True
+            # Close the socket before joining, the user channel can stay silent
+            # indefinitely while no orders are moving so recv() may never return
+            try:
+                if self.ws:
+                    self.ws.close()
+            except WebSocketConnectionClosedException:
+                self.error_logger.exception(datetime.datetime.now())
+                pass
+            if self.thread:
+                self.thread.join(timeout=CLOSE_TIMEOUT)
+
+    def on_message(self, msg):
+        if msg.get('type') == 'error':
+            # A rejected subscription (bad key, passphrase or permissions) arrives as
+            # a message and leaves the socket open, so mark the feed as failed here
+            self.error_logger.error("%s User websocket error: %s %s" % (datetime.datetime.now(), msg.get('message'), msg.get('reason')))
+            self.error = Exception(msg.get('message'))
+            return
+        if self.callback:
+            # Errors here would otherwise silently end the listener thread
+            try:
+                self.callback(msg)
+            except Exception:
+                self.error_logger.exception(datetime.datetime.now())
@@ -1,4 +1,5 @@
 from .OrderBookCustom import OrderBookCustom
 from .Product import Product
 from .TradeEngine import TradeEngine
-from .TradeAndHeartbeatWebsocket import TradeAndHeartbeatWebsocket
\ No newline at end of file
+from .TradeAndHeartbeatWebsocket import TradeAndHeartbeatWebsocket
+from .UserWebsocket import UserWebsocket
\ No newline at end of file
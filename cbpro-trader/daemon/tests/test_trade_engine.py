@@ -0,0 +1,311 @@
+#
+# test_trade_engine.py
+#
+# Pytest tests on the trade engine's order handling
+
+import engine
+import logging
+import threading
+from decimal import Decimal
+from concurrent.futures import Future
+from unittest.mock import MagicMock
+
+
+def make_product(product_id='BTC-USD', bid='100.00', ask='100.00'):
+    # Built without __init__ so no order book websocket or REST calls are made
+    product = engine.Product.__new__(engine.Product)
+    product.product_id = product_id
+    product.meta = False
+    product.lock = threading.Lock()
+    product.order_in_progress = False
+    product.buy_flag = False
+    product.sell_flag = False
+    product.open_orders = []
+    product.live_order_ids = set()
+    product.last_order_event = 0
+    product.quote_increment = '0.01'
+    product.min_size = '0.001'
+    product.quote_increment_d = Decimal('0.01')
+    product.min_size_d = Decimal('0.001')
+    product.book = {'bid': Decimal(bid), 'ask': Decimal(ask)}
+    product.order_book = MagicMock()
+    product.order_book.get_bid.side_effect = lambda: product.book['bid']
+    product.order_book.get_ask.side_effect = lambda: product.book['ask']
+    return product
+
+
+def make_engine(product, auth_client=None):
+    # Built without __init__ so no update_orders thread or REST calls are made
+    trade_engine = engine.TradeEngine.__new__(engine.TradeEngine)
+    trade_engine.logger = logging.getLogger('trader-logger')
+    trade_engine.error_logger = logging.getLogger('error-logger')
+    trade_engine.auth_client = auth_client or MagicMock()
+    trade_engine.fiat_currency = 'USD'
+    trade_engine.products = [product]
+    trade_engine.product_by_id = {product.product_id: product}
+    trade_engine.currency_map = {product.product_id: (product.product_id[:3], product.product_id[4:])}
+    trade_engine.balances = {'BTC': Decimal('10.0'), 'USD': Decimal('1000.00'), 'fiat_equivalent': Decimal('0.0')}
+    # Never stale, so balance getters don't try to refresh
+    trade_engine.last_balance_update = float('inf')
+    trade_engine.max_slippage = Decimal('0.10')
+    trade_engine.all_open_orders = []
+    return trade_engine
+
+
+def order(order_id, side='buy', price='99.99', size='1.00000000', status='open'):
+    return {'id': order_id, 'product_id': 'BTC-USD', 'side': side,
+            'price': price, 'size': size, 'filled_size': '0', 'status': status}
+
+
+class TestProcessOrderMessage(object):
+    def setup_method(self):
+        self.product = make_product()
+        self.trade_engine = make_engine(self.product)
+
+    def test_open_adds_new_order(self):
+        self.trade_engine.process_order_message({'type': 'open', 'product_id': 'BTC-USD', 'order_id': 'a',
+                                                 'side': 'buy', 'price': '99.99', 'remaining_size': '1.5'})
+
+        assert len(self.product.open_orders) == 1
+        assert self.product.open_orders[0]['id'] == 'a'
+        assert self.product.open_orders[0]['size'] == '1.5'
+        assert self.product.open_orders[0]['status'] == 'open'
+        assert self.product.live_order_ids == {'a'}
+        assert self.trade_engine.all_open_orders == self.product.open_orders
+        assert self.product.last_order_event > 0
+
+    def test_match_updates_maker_filled_size(self):
+        self.product.open_orders = [order('a')]
+        self.product.live_order_ids = {'a'}
+        self.trade_engine.process_order_message({'type': 'match', 'product_id': 'BTC-USD', 'maker_order_id': 'a',
+                                                 'taker_order_id': 'z', 'size': '0.25'})
+
+        assert len(self.product.open_orders) == 1
+        assert Decimal(self.product.open_orders[0]['filled_size']) == Decimal('0.25')
+        assert self.product.live_order_ids == {'a'}
+
+    def test_change_updates_size(self):
+        self.product.open_orders = [order('a')]
+        self.product.live_order_ids = {'a'}
+        self.trade_engine.process_order_message({'type': 'change', 'product_id': 'BTC-USD', 'order_id': 'a',
+                                                 'new_size': '0.5'})
+
+        assert self.product.open_orders[0]['size'] == '0.5'
+
+    def test_done_removes_order(self):
+        self.product.open_orders = [order('a'), order('b')]
+        self.product.live_order_ids = {'a', 'b'}
+        old_open_orders = self.product.open_orders
+        self.trade_engine.process_order_message({'type': 'done', 'product_id': 'BTC-USD', 'order_id': 'a',
+                                                 'reason': 'filled'})
+
+        assert [o['id'] for o in self.product.open_orders] == ['b']
+        assert self.product.live_order_ids == {'b'}
+        # Published by replacement, the old list is untouched
+        assert len(old_open_orders) == 2
+
+    def test_unknown_product_ignored(self):
+        self.trade_engine.process_order_message({'type': 'done', 'product_id': 'ETH-USD', 'order_id': 'a'})
+
+        assert self.product.open_orders == []
+
+
+class TestUserWebsocket(object):
+    def setup_method(self):
+        self.websocket = engine.UserWebsocket('key', 'c2VjcmV0', 'passphrase')
+        self.websocket.stop = False
+        self.websocket.thread = MagicMock()
+        self.websocket.thread.is_alive.return_value = True
+        self.websocket.callback = MagicMock()
+
+    def test_order_message_passed_to_callback(self):
+        msg = {'type': 'done', 'product_id': 'BTC-USD', 'order_id': 'a'}
+        self.websocket.on_message(msg)
+
+        self.websocket.callback.assert_called_once_with(msg)
+        assert self.websocket.is_alive() is True
+
+    def test_error_message_marks_feed_dead(self):
+        self.websocket.on_message({'type': 'error', 'message': 'Authentication Failed'})
+
+        self.websocket.callback.assert_not_called()
+        assert self.websocket.is_alive() is False
+
+
+class TestFindOpenOrder(object):
+    def test_cancelled_order_not_returned(self):
+        product = make_product()
+        auth_client = MagicMock()
+        auth_client.place_limit_order.return_value = order('2', price='99.99', size='5.00050005')
+        trade_engine = make_engine(product, auth_client)
+        product.open_orders = [order('1', price='99.99', size='5.00050005')]
+        product.live_order_ids = {'1'}
+
+        assert trade_engine.find_open_order(product, 'buy', Decimal('99.99'), Decimal('5.00050005'))['id'] == '1'
+
+        trade_engine.cancel_product_orders(product)
+
+        # Marked so an in-flight REST reconcile can't restore the cancelled order
+        assert product.last_order_event > 0
+        assert trade_engine.find_open_order(product, 'buy', Decimal('99.99')) is None
+        ret = trade_engine.place_buy(product=product, partial=Decimal('0.5'))
+        assert ret['id'] == '2'
+        auth_client.place_limit_order.assert_called_once_with('BTC-USD', 'buy', size='5.00050005',
+                                                              price='99.99', post_only=True)
+
+
+class TestTrade(object):
+    def make(self, side):
+        product = make_product()
+        auth_client = MagicMock()
+        auth_client.place_limit_order.side_effect = lambda product_id, side, size, price, post_only: \
+            order(str(auth_client.place_limit_order.call_count), side=side, price=price, size=size)
+        auth_client.get_order.side_effect = lambda order_id: next(o for o in product.open_orders if o['id'] == order_id)
+        setattr(product, side + '_flag', True)
+        return product, auth_client, make_engine(product, auth_client)
+
+    def stop_after_get_order(self, product, auth_client, side):
+        lookup = auth_client.get_order.side_effect
+
+        def get_order(order_id):
+            setattr(product, side + '_flag', False)
+            return lookup(order_id)
+        auth_client.get_order.side_effect = get_order
+
+    def test_buy_slippage_places_market_order_with_funds(self):
+        product, auth_client, trade_engine = self.make('buy')
+        self.stop_after_get_order(product, auth_client, 'buy')
+        auth_client.place_limit_order.side_effect = lambda *args, **kwargs: \
+            product.book.update(ask=Decimal('101.00')) or order('1')
+
+        trade_engine.buy(product=product)
+
+        auth_client.place_market_order.assert_called_once_with('BTC-USD', 'buy', funds='1000.00')
+        assert product.open_orders == []
+        assert product.order_in_progress is False
+
+    def test_sell_slippage_places_market_order_with_size(self):
+        product, auth_client, trade_engine = self.make('sell')
+        self.stop_after_get_order(product, auth_client, 'sell')
+        auth_client.place_limit_order.side_effect = lambda *args, **kwargs: \
+            product.book.update(bid=Decimal('99.00')) or order('1', side='sell', price='100.01')
+
+        trade_engine.sell(product=product)
+
+        auth_client.place_market_order.assert_called_once_with('BTC-USD', 'sell', size='10.0')
+        assert product.open_orders == []
+
+    def test_buy_no_slippage_when_ask_falls(self):
+        product, auth_client, trade_engine = self.make('buy')
+        self.stop_after_get_order(product, auth_client, 'buy')
+        product.book['ask'] = Decimal('100.00')
+        place = auth_client.place_limit_order.side_effect
+        auth_client.place_limit_order.side_effect = lambda *args, **kwargs: \
+            product.book.update(ask=Decimal('95.00')) or place(*args, **kwargs)
+
+        trade_engine.buy(product=product)
+
+        auth_client.place_market_order.assert_not_called()
+        # Resting bid is already above the new target, nothing to chase
+        assert auth_client.place_limit_order.call_count == 1
+
+    def test_buy_reissues_when_ask_rises(self):
+        product, auth_client, trade_engine = self.make('buy')
+        self.stop_after_get_order(product, auth_client, 'buy')
+        place = auth_client.place_limit_order.side_effect
+
+        def place_limit_order(*args, **kwargs):
+            product.book['ask'] = Decimal('100.05')
+            return place(*args, **kwargs)
+        auth_client.place_limit_order.side_effect = place_limit_order
+
+        trade_engine.buy(product=product)
+
+        auth_client.place_market_order.assert_not_called()
+        assert auth_client.place_limit_order.call_count == 2
+        first, second = auth_client.place_limit_order.call_args_list
+        assert first[1]['price'] == '99.99'
+        assert second[1]['price'] == '100.04'
+        # Reissued with the whole balance since an order was already open
+        assert second[1]['size'] == str(trade_engine.round_coin(Decimal('1000.00') / Decimal('100.04')))
+        auth_client.cancel_all.assert_any_call(product_id='BTC-USD')
+
+    def test_sell_reissues_when_bid_falls(self):
+        product, auth_client, trade_engine = self.make('sell')
+        self.stop_after_get_order(product, auth_client, 'sell')
+        place = auth_client.place_limit_order.side_effect
+
+        def place_limit_order(*args, **kwargs):
+            product.book['bid'] = Decimal('99.95')
+            return place(*args, **kwargs)
+        auth_client.place_limit_order.side_effect = place_limit_order
+
+        trade_engine.sell(product=product)
+
+        auth_client.place_market_order.assert_not_called()
+        assert auth_client.place_limit_order.call_count == 2
+        first, second = auth_client.place_limit_order.call_args_list
+        assert first[1]['price'] == '100.01'
+        assert second[1]['price'] == '99.96'
+
+    def test_sell_no_reissue_when_bid_rises(self):
+        product, auth_client, trade_engine = self.make('sell')
+        self.stop_after_get_order(product, auth_client, 'sell')
+        place = auth_client.place_limit_order.side_effect
+        auth_client.place_limit_order.side_effect = lambda *args, **kwargs: \
+            product.book.update(bid=Decimal('100.05')) or place(*args, **kwargs)
+
+        trade_engine.sell(product=product)
+
+        auth_client.place_market_order.assert_not_called()
+        assert auth_client.place_limit_order.call_count == 1
+
+    def test_buy_chases_when_placed_below_target(self):
+        product, auth_client, trade_engine = self.make('buy')
+        place = auth_client.place_limit_order.side_effect
+        # Book dips just as place_buy reads it, then recovers
+        product.order_book.get_ask.side_effect = iter([Decimal('100.00'), Decimal('99.50'),
+                                                       Decimal('100.00'), Decimal('100.00'), Decimal('100.00')])
+
+        def place_limit_order(*args, **kwargs):
+            if auth_client.place_limit_order.call_count == 2:
+                product.buy_flag = False
+            return place(*args, **kwargs)
+        auth_client.place_limit_order.side_effect = place_limit_order
+
+        trade_engine.buy(product=product)
+
+        first, second = auth_client.place_limit_order.call_args_list
+        assert first[1]['price'] == '99.49'
+        assert second[1]['price'] == '99.99'
+
+    def test_empty_book_releases_product(self):
+        product, auth_client, trade_engine = self.make('buy')
+        product.order_book.get_ask.side_effect = ValueError('empty book')
+
+        trade_engine.buy(product=product)
+
+        auth_client.place_limit_order.assert_not_called()
+        assert product.order_in_progress is False
+
+    def test_failed_cancel_releases_product(self):
+        product, auth_client, trade_engine = self.make('buy')
+        product.buy_flag = False
+        auth_client.cancel_all.side_effect = ValueError('rate limited')
+
+        try:
+            trade_engine.buy(product=product)
+        except ValueError:
+            pass
+
+        assert product.order_in_progress is False
+
+    def test_order_future_exception_logged(self, mocker):
+        product, auth_client, trade_engine = self.make('buy')
+        trade_engine.error_logger = mocker.Mock()
+        future = Future()
+        future.set_exception(ValueError('boom'))
+
+        trade_engine.log_order_future(future)
+
+        assert trade_engine.error_logger.error.call_count == 1